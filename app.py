@@ -2,19 +2,27 @@
 # Author: Gary A. Stafford
 # Date: 2024-08-21
 
-import base64
+import asyncio
 import datetime
+import hashlib
 import io
 import json
 import logging
-import time
+import os
+import re
+import sqlite3
+import threading
+from contextlib import closing
 from io import StringIO
 from operator import index
 
 import boto3
+import numpy as np
+import orjson
+import pybase64
 import streamlit as st
-from botocore.exceptions import ClientError
-from PIL import Image
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 
 # Configure logging
@@ -22,6 +30,10 @@ class ImageError(Exception):
     "Custom exception for errors returned by Amazon Titan Image Generator G1"
 
 
+class ThrottlingError(Exception):
+    "Custom exception for requests throttled by Amazon Bedrock after all retries"
+
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -30,122 +42,816 @@ logging.basicConfig(
 # Amazon Bedrock model ID
 MODEL_ID = "amazon.titan-image-generator-v2:0"
 
+# Default prompts shown in the form
+DEFAULT_POSITIVE_PROMPT = "Picturesque picnic scene in a sunlit park. Close-up view of a vibrant red and white checkered blanket spread out on lush, verdant grass. A single white plate sits at the center of the blanket. Towering, leafy trees frame the background, casting dappled shadows. Patches of azure sky peek through the canopy. Warm, cheerful atmosphere with soft lighting. Photorealistic style, high detail, 4K resolution."
+DEFAULT_NEGATIVE_PROMPT = "people, humans, animals, worst quality, low quality, low res, oversaturated, undersaturated, overexposed, underexposed, grayscale, b&w, bad photo, bad photography, bad art, watermark, signature, blur, blurry, grainy, ugly, asymmetrical, poorly lit, bad shadow, draft, cropped, out of frame, cut off, censored, jpeg artifacts, out of focus, glitch, duplicate, airbrushed, cartoon, anime, semi-realistic, cgi, render, blender, digital art, manga, amateur, 3D"
+
+# Negative prompt used when the form's negative prompt is left empty
+FALLBACK_NEGATIVE_PROMPT = "worst quality, low quality, low res, bad photo, bad photography, bad art, blur, blurry, grainy, ugly, asymmetrical, poorly lit, bad shadow, draft, cropped, out of frame, cut off, censored, jpeg artifacts, out of focus, glitch"
+
+# Locates the start of the base64 image in the raw response body
+IMAGES_PATTERN = re.compile(rb'"images"\s*:\s*\[\s*"')
+
+# Stands in for the base64 image when serializing the rest of the request body
+IMAGE_PLACEHOLDER = "__IMAGE__"
+
+# Largest seed accepted by Amazon Titan Image Generator
+MAX_SEED = 2147483647
+
+# Largest width or height accepted by Amazon Titan Image Generator
+MAX_IMAGE_SIZE = 1408
+
+# Image modes by PNG color type and by number of JPEG components, as named by Pillow
+PNG_MODES = {0: "L", 2: "RGB", 3: "P", 4: "LA", 6: "RGBA"}
+JPEG_MODES = {1: "L", 3: "RGB", 4: "CMYK"}
+
+# JPEG start-of-frame markers, which hold the image dimensions
+JPEG_SOF_MARKERS = {
+    0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF
+}
+
+# Amazon Bedrock embeddings model ID, used for approximate prompt matching
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v2:0"
+
+# Generated images are cached on disk, keyed by source image and inference parameters
+CACHE_DIR = "output/cache"
+
+# Embeddings of previously used positive prompts, for approximate prompt matching
+PROMPT_INDEX_PATH = f"{CACHE_DIR}/prompts.db"
+
+
+@st.cache_resource
+def get_bedrock_runtime():
+    """
+    Create the Amazon Bedrock Runtime client once and share it across reruns and sessions.
+    Its connection is warmed up in the background, so also only once per process.
+    Returns:
+        bedrock_runtime (BedrockRuntime.Client): The Amazon Bedrock Runtime client.
+    """
+    config = Config(
+        retries={"mode": "adaptive", "max_attempts": 4},
+        connect_timeout=3,
+        read_timeout=90,
+        tcp_keepalive=True,
+        max_pool_connections=16,
+    )
+    bedrock_runtime = boto3.client(
+        service_name="bedrock-runtime", region_name="us-east-1", config=config
+    )
+    threading.Thread(
+        target=warm_up_bedrock_runtime, args=(bedrock_runtime,), daemon=True
+    ).start()
+    return bedrock_runtime
+
+
+def warm_up_bedrock_runtime(bedrock_runtime):
+    """
+    Establish the pooled HTTPS connection to Amazon Bedrock Runtime ahead of the first request,
+    so DNS, TLS and credential resolution are not paid on the first submit.
+    The request body is intentionally empty and is rejected by the model.
+    Args:
+        bedrock_runtime (BedrockRuntime.Client): The Amazon Bedrock Runtime client.
+    Returns:
+        None
+    """
+    try:
+        bedrock_runtime.invoke_model(
+            body="{}",
+            modelId=MODEL_ID,
+            contentType="application/json",
+            accept="application/json",
+        )
+    except (BotoCoreError, ClientError) as err:
+        logger.info("Warmed up Amazon Bedrock Runtime connection: %s", err)
+
+
+def parse_image_response(raw_body):
+    """
+    Split the raw response body into its small JSON envelope and the base64 image,
+    so that the multi-MB image is never parsed as JSON or copied into a str.
+    Falls back to parsing the whole body if the image cannot be located.
+    Args:
+        raw_body (bytes): The raw response body returned by the model.
+    Returns:
+        finish_reason (str): The error returned by the model, if any.
+        base64_image (memoryview): The base64-encoded image, or None if there is no image.
+    """
+    match = IMAGES_PATTERN.search(raw_body)
+    end = raw_body.find(b'"', match.end()) if match else -1
+
+    if end == -1:
+        response_body = json.loads(raw_body)
+        images = response_body.get("images") or []
+        base64_image = images[0] if images else None
+    else:
+        base64_image = memoryview(raw_body)[match.end() : end]
+        response_body = json.loads(raw_body[: match.end()] + raw_body[end:])
+
+    return response_body.get("error"), base64_image
+
+
+async def invoke_model(body, model_id, **kwargs):
+    """
+    Invoke a model on Amazon Bedrock and read the raw response body.
+    The blocking Amazon Bedrock call runs in a worker thread so the event loop is not blocked.
+    Args:
+        body (bytes) : The request body to use.
+        model_id (str): The model ID to invoke.
+        **kwargs: Additional arguments passed to invoke_model.
+    Returns:
+        raw_body (bytes): The raw response body returned by the model.
+    Raises:
+        ThrottlingError: If Amazon Bedrock is still throttling requests after all retries.
+    """
+
+    bedrock_runtime = get_bedrock_runtime()
+
+    try:
+        response = await asyncio.to_thread(
+            bedrock_runtime.invoke_model,
+            body=body,
+            modelId=model_id,
+            contentType="application/json",
+            accept="application/json",
+            **kwargs,
+        )
+    except ClientError as err:
+        if err.response["Error"]["Code"] == "ThrottlingException":
+            raise ThrottlingError(err.response["Error"]["Message"]) from err
+        raise
+    return await asyncio.to_thread(response.get("body").read)
+
 
-def generate_image(body):
+async def generate_image(body, latency_optimized=False):
     """
     Generate an image using Amazon Titan Image Generator G1 model on demand.
     Args:
-        body (str) : The request body to use.
+        body (bytes) : The request body to use.
+        latency_optimized (bool): Whether to use latency-optimized inference.
     Returns:
         image_bytes (bytes): The image generated by the model.
     """
 
-    bedrock_runtime = boto3.client(service_name="bedrock-runtime", region_name="us-east-1")
-
-    response = bedrock_runtime.invoke_model(
-        body=body,
-        modelId=MODEL_ID,
-        contentType="application/json",
-        accept="application/json",
+    # Only send the latency setting when requested, since few models support it.
+    performance_config = (
+        {"performanceConfigLatency": "optimized"} if latency_optimized else {}
+    )
+    logger.info(
+        "Using %s latency inference", "optimized" if latency_optimized else "standard"
     )
-    response_body = json.loads(response.get("body").read())
-    base64_image = response_body.get("images")[0]
-    base64_bytes = base64_image.encode("ascii")
-    image_bytes = base64.b64decode(base64_bytes)
 
-    finish_reason = response_body.get("error")
+    raw_body = await invoke_model(body, MODEL_ID, **performance_config)
+    finish_reason, base64_image = parse_image_response(raw_body)
 
     if finish_reason is not None:
         raise ImageError(f"Image generation error: {finish_reason}")
+    if not base64_image:
+        raise ImageError("Image generation error: no image returned")
+
+    image_bytes = pybase64.b64decode(base64_image, validate=False)
 
     logger.info("Successfully generated image with model: %s", MODEL_ID)
 
     return image_bytes
 
 
+def read_image_info(image_bytes):
+    """
+    Read the format, mode and size of a PNG or JPEG image from its header,
+    without decoding the image.
+    Args:
+        image_bytes (bytes): The image.
+    Returns:
+        image_info (dict): The format description, mode, width and height of the image,
+            or None if the image is not a valid PNG or JPEG.
+    """
+    if (
+        image_bytes.startswith(b"\x89PNG\r\n\x1a\n")
+        and image_bytes[12:16] == b"IHDR"
+        and len(image_bytes) >= 26
+    ):
+        return {
+            "format_description": "Portable network graphics",
+            "mode": PNG_MODES.get(image_bytes[25]),
+            "width": int.from_bytes(image_bytes[16:20], "big"),
+            "height": int.from_bytes(image_bytes[20:24], "big"),
+        }
+
+    if image_bytes.startswith(b"\xff\xd8"):
+        offset = 2
+        while offset + 4 <= len(image_bytes):
+            if image_bytes[offset] != 0xFF:
+                return None
+            marker = image_bytes[offset + 1]
+            # Fill bytes and standalone markers have no segment length.
+            if marker == 0xFF:
+                offset += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+                offset += 2
+                continue
+            segment_length = int.from_bytes(image_bytes[offset + 2 : offset + 4], "big")
+            if marker in JPEG_SOF_MARKERS and offset + 10 <= len(image_bytes):
+                return {
+                    "format_description": "JPEG (ISO 10918)",
+                    "mode": JPEG_MODES.get(image_bytes[offset + 9]),
+                    "width": int.from_bytes(image_bytes[offset + 7 : offset + 9], "big"),
+                    "height": int.from_bytes(image_bytes[offset + 5 : offset + 7], "big"),
+                }
+            offset += 2 + segment_length
+
+    return None
+
+
+@st.cache_data(show_spinner=False)
+def downscale_image(image_bytes):
+    """
+    Downscale an image to fit within the maximum size accepted by the model,
+    re-encoding it as JPEG to reduce the request payload, or as PNG if it has transparency.
+    Args:
+        image_bytes (bytes): The image to downscale.
+    Returns:
+        image_bytes (bytes): The downscaled image.
+    """
+    # Pillow is only needed for oversized images, so it is imported on demand.
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(image_bytes))
+    # Apply the EXIF orientation, since EXIF is not carried over to the re-encoded image.
+    image = ImageOps.exif_transpose(image)
+    # Convert before resizing, since palette images are only resized with nearest neighbor.
+    has_transparency = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+    image = image.convert("RGBA" if has_transparency else "RGB")
+    image.thumbnail((MAX_IMAGE_SIZE, MAX_IMAGE_SIZE), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    if has_transparency:
+        image.save(buffer, format="PNG", optimize=True)
+    else:
+        image.save(buffer, format="JPEG", quality=92, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+async def embed_prompt(prompt):
+    """
+    Embed a prompt using Amazon Titan Text Embeddings V2 model on demand.
+    Args:
+        prompt (str): The prompt to embed.
+    Returns:
+        embedding (np.ndarray): The normalized embedding of the prompt.
+    """
+
+    raw_body = await invoke_model(
+        orjson.dumps({"inputText": prompt, "normalize": True}), EMBEDDING_MODEL_ID
+    )
+    response_body = json.loads(raw_body)
+
+    return np.array(response_body.get("embedding"), dtype=np.float32)
+
+
+async def try_embed_prompt(prompt):
+    """
+    Embed a prompt for approximate prompt matching, which is only an optimization,
+    so any failure is treated as no similar match rather than failing the request.
+    Args:
+        prompt (str): The prompt to embed.
+    Returns:
+        embedding (np.ndarray): The normalized embedding of the prompt, or None on failure.
+    """
+    try:
+        return await embed_prompt(prompt)
+    except (BotoCoreError, ClientError, ThrottlingError) as err:
+        logger.warning(f"Unable to embed prompt, skipping similar prompt matching: {err}")
+        return None
+
+
+def connect_prompt_index():
+    """
+    Open the prompt index, creating it if it does not exist.
+    Returns:
+        connection (sqlite3.Connection): The connection to the prompt index.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    connection = sqlite3.connect(PROMPT_INDEX_PATH)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS prompts (params_key TEXT, embedding BLOB, image_path TEXT)"
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS prompts_params_key ON prompts (params_key)"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS reused_images (image_path TEXT PRIMARY KEY, similarity REAL)"
+    )
+    return connection
+
+
+def find_similar_image(params_key, embedding, similarity_threshold):
+    """
+    Find a previously generated image whose positive prompt is similar to the given one.
+    Args:
+        params_key (str): The key of every input other than the positive prompt.
+        embedding (np.ndarray): The normalized embedding of the positive prompt.
+        similarity_threshold (float): The minimum cosine similarity to accept.
+    Returns:
+        image_path (str): The path to the most similar image, or None if there is no match.
+        similarity (float): The cosine similarity of the most similar prompt, or None.
+    """
+    with closing(connect_prompt_index()) as connection:
+        rows = connection.execute(
+            "SELECT embedding, image_path FROM prompts WHERE params_key = ?",
+            (params_key,),
+        ).fetchall()
+
+    rows = [row for row in rows if os.path.exists(row[1])]
+    if not rows:
+        return None, None
+
+    embeddings = np.stack([np.frombuffer(row[0], dtype=np.float32) for row in rows])
+    similarities = embeddings @ embedding
+    best = int(np.argmax(similarities))
+    if similarities[best] < similarity_threshold:
+        return None, None
+
+    logger.info(
+        "Similar prompt found (cosine similarity %.3f): %s",
+        similarities[best],
+        rows[best][1],
+    )
+    return rows[best][1], float(similarities[best])
+
+
+def add_to_prompt_index(params_key, embedding, image_path):
+    """
+    Add a generated image to the prompt index.
+    Args:
+        params_key (str): The key of every input other than the positive prompt.
+        embedding (np.ndarray): The normalized embedding of the positive prompt.
+        image_path (str): The path to the generated image.
+    Returns:
+        None
+    """
+    with closing(connect_prompt_index()) as connection, connection:
+        connection.execute(
+            "INSERT INTO prompts (params_key, embedding, image_path) VALUES (?, ?, ?)",
+            (params_key, embedding.tobytes(), image_path),
+        )
+
+
+def add_reused_image(image_path, similarity):
+    """
+    Record that a cached image was reused from a similar prompt, not generated from its own.
+    Args:
+        image_path (str): The path the reused image was cached under.
+        similarity (float): The cosine similarity of the prompt it was reused from.
+    Returns:
+        None
+    """
+    with closing(connect_prompt_index()) as connection, connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO reused_images (image_path, similarity) VALUES (?, ?)",
+            (image_path, similarity),
+        )
+
+
+def remove_reused_image(image_path):
+    """
+    Remove the record of a cached image being reused from a similar prompt.
+    Args:
+        image_path (str): The path the reused image was cached under.
+    Returns:
+        None
+    """
+    with closing(connect_prompt_index()) as connection, connection:
+        connection.execute(
+            "DELETE FROM reused_images WHERE image_path = ?", (image_path,)
+        )
+
+
+def get_reused_similarity(image_path):
+    """
+    Look up whether a cached image was reused from a similar prompt.
+    Args:
+        image_path (str): The path to the cached image.
+    Returns:
+        similarity (float): The cosine similarity of the prompt it was reused from,
+            or None if the image was generated from its own prompt.
+    """
+    if not os.path.exists(PROMPT_INDEX_PATH):
+        return None
+    with closing(connect_prompt_index()) as connection:
+        row = connection.execute(
+            "SELECT similarity FROM reused_images WHERE image_path = ?",
+            (image_path,),
+        ).fetchone()
+    return row[0] if row else None
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def get_request_body_template(
+    mask_prompt,
+    positive_prompt,
+    negative_prompt,
+    outpainting_mode,
+    cfg_scale,
+    seed,
+):
+    """
+    Serialize the request body around the source image, so the base64 image can be
+    written between the two halves without the serializer scanning it for escapes.
+    Cached, so the body is only serialized again when the inputs change.
+    Args:
+        mask_prompt (str): The mask prompt to use.
+        positive_prompt (str): The positive prompt to use.
+        negative_prompt (str): The negative prompt to use.
+        outpainting_mode (str): The outpainting mode to use.
+        cfg_scale (float): The CFG scale to use.
+        seed (int): The seed to use.
+    Returns:
+        body_prefix (bytes): The request body up to the opening quote of the image.
+        body_suffix (bytes): The request body from the closing quote of the image.
+    """
+    body = orjson.dumps(
+        {
+            "taskType": "OUTPAINTING",
+            "outPaintingParams": {
+                "text": positive_prompt,
+                "negativeText": negative_prompt,
+                "image": IMAGE_PLACEHOLDER,
+                "maskPrompt": mask_prompt,
+                "outPaintingMode": outpainting_mode,
+            },
+            "imageGenerationConfig": {
+                "numberOfImages": 1,
+                # "height": image_height,
+                # "width": image_height,
+                "cfgScale": cfg_scale,
+                "seed": seed,
+            },
+        }
+    )
+    # Quotes inside prompts are escaped, so this unescaped key and value only occur once.
+    body_prefix, body_suffix = body.split(f'"image":"{IMAGE_PLACEHOLDER}"'.encode())
+    return body_prefix + b'"image":"', b'"' + body_suffix
+
+
+def get_image_extension(image_bytes):
+    """
+    Detect the file extension of an image from its magic bytes.
+    Args:
+        image_bytes (bytes): The image.
+    Returns:
+        extension (str): The file extension of the image.
+    """
+    if image_bytes.startswith(b"\xff\xd8"):
+        return "jpg"
+    return "png"
+
+
+def find_cached_image(cache_key, similarity_threshold):
+    """
+    Find a previously generated image in the cache. An image that was reused from a
+    similar prompt only matches while its similarity still meets the threshold.
+    Args:
+        cache_key (str): The cache key of the request.
+        similarity_threshold (float): The minimum cosine similarity for reusing an image
+            generated from a similar positive prompt.
+    Returns:
+        generated_image_path (str): The path to the cached image, or None if there is no match.
+        similarity (float): The cosine similarity of the prompt the image was reused from,
+            or None if the image was generated from this prompt.
+    """
+    for extension in ("png", "jpg"):
+        generated_image_path = f"{CACHE_DIR}/{cache_key}.{extension}"
+        if os.path.exists(generated_image_path):
+            similarity = get_reused_similarity(generated_image_path)
+            if similarity is not None and similarity < similarity_threshold:
+                logger.info(
+                    "Ignoring cached image reused below the similarity threshold: %s",
+                    generated_image_path,
+                )
+                return None, None
+            return generated_image_path, similarity
+    return None, None
+
+
+def remove_cached_image(cache_key):
+    """
+    Remove any image cached under a key, along with any record of it being reused.
+    Args:
+        cache_key (str): The cache key of the request.
+    Returns:
+        None
+    """
+    for extension in ("png", "jpg"):
+        generated_image_path = f"{CACHE_DIR}/{cache_key}.{extension}"
+        if os.path.exists(generated_image_path):
+            os.remove(generated_image_path)
+            remove_reused_image(generated_image_path)
+
+
+def write_image(image_path, image_bytes):
+    """
+    Write an image to file with unbuffered writes, since it is written all at once.
+    Args:
+        image_path (str): The path to write the image to.
+        image_bytes (bytes): The image.
+    Returns:
+        None
+    """
+    # O_BINARY only exists, and is required, on Windows.
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = os.open(image_path, flags, 0o644)
+    try:
+        image_view = memoryview(image_bytes)
+        while image_view:
+            image_view = image_view[os.write(fd, image_view) :]
+    finally:
+        os.close(fd)
+
+
+def read_image(image_path):
+    """
+    Read an image from file.
+    Args:
+        image_path (str): The path to the image.
+    Returns:
+        image_bytes (bytes): The image.
+    """
+    with open(image_path, "rb") as image_file:
+        return image_file.read()
+
+
+def get_cache_key(
+    input_image_hash,
+    mask_prompt,
+    positive_prompt,
+    negative_prompt,
+    outpainting_mode,
+    cfg_scale,
+    seed,
+):
+    """
+    Compute the cache key for a request. Titan is deterministic for a fixed seed,
+    so identical inputs always produce an identical image.
+    Args:
+        input_image_hash (str): The SHA-256 hex digest of the source image.
+        mask_prompt (str): The mask prompt to use.
+        positive_prompt (str): The positive prompt to use.
+        negative_prompt (str): The negative prompt to use.
+        outpainting_mode (str): The outpainting mode to use.
+        cfg_scale (float): The CFG scale to use.
+        seed (int): The seed to use.
+    Returns:
+        cache_key (str): The SHA-256 hex digest of the inputs.
+    """
+    # Serialize the inputs as a JSON array, so distinct inputs never share a key.
+    return hashlib.sha256(
+        orjson.dumps(
+            [
+                input_image_hash,
+                mask_prompt,
+                positive_prompt,
+                negative_prompt,
+                outpainting_mode,
+                cfg_scale,
+                seed,
+            ]
+        )
+    ).hexdigest()
+
+
+async def generate_candidate(
+    input_image,
+    input_image_hash,
+    cache_key,
+    mask_prompt,
+    positive_prompt,
+    negative_prompt,
+    outpainting_mode,
+    cfg_scale,
+    seed,
+    latency_optimized,
+    similarity_threshold,
+    embedding,
+):
+    """
+    Generate a single candidate image, reusing a cached image where possible.
+    Args:
+        input_image (bytes): The base64-encoded source image.
+        input_image_hash (str): The SHA-256 hex digest of the source image.
+        cache_key (str): The cache key of the request.
+        mask_prompt (str): The mask prompt to use.
+        positive_prompt (str): The positive prompt to use.
+        negative_prompt (str): The negative prompt to use.
+        outpainting_mode (str): The outpainting mode to use.
+        cfg_scale (float): The CFG scale to use.
+        seed (int): The seed to use.
+        latency_optimized (bool): Whether to use latency-optimized inference.
+        similarity_threshold (float): The minimum cosine similarity for reusing an image
+            generated from a similar positive prompt.
+        embedding (np.ndarray): The embedding of the positive prompt, or None to
+            disable approximate matching.
+    Returns:
+        generated_image_path (str): The path to the generated image.
+        image_bytes (bytes): The generated image.
+        similarity (float): The cosine similarity of the prompt the image was reused from,
+            or None if the image was generated from this prompt.
+    """
+    generated_image_path, similarity = find_cached_image(
+        cache_key, similarity_threshold
+    )
+    if generated_image_path:
+        logger.info("Cached image found: %s", generated_image_path)
+        return generated_image_path, read_image(generated_image_path), similarity
+
+    # Reuse an image generated from a similar positive prompt, with all other inputs equal.
+    if embedding is not None:
+        params_key = get_cache_key(
+            input_image_hash,
+            mask_prompt,
+            "",
+            negative_prompt,
+            outpainting_mode,
+            cfg_scale,
+            seed,
+        )
+        similar_image_path, similarity = find_similar_image(
+            params_key, embedding, similarity_threshold
+        )
+        if similar_image_path:
+            # Cache the reused image under this prompt, so repeating it is an exact hit.
+            image_bytes = read_image(similar_image_path)
+            generated_image_path = (
+                f"{CACHE_DIR}/{cache_key}.{get_image_extension(image_bytes)}"
+            )
+            write_image(generated_image_path, image_bytes)
+            add_reused_image(generated_image_path, similarity)
+            return generated_image_path, image_bytes, similarity
+
+    body_prefix, body_suffix = get_request_body_template(
+        mask_prompt,
+        positive_prompt,
+        negative_prompt,
+        outpainting_mode,
+        cfg_scale,
+        seed,
+    )
+    image_bytes = await generate_image(
+        body=body_prefix + input_image + body_suffix,
+        latency_optimized=latency_optimized,
+    )
+    # Write the image as returned by the model, without decoding and re-encoding it,
+    # replacing any image that was reused for this prompt below the current threshold.
+    generated_image_path = f"{CACHE_DIR}/{cache_key}.{get_image_extension(image_bytes)}"
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    remove_cached_image(cache_key)
+    write_image(generated_image_path, image_bytes)
+    if embedding is not None:
+        add_to_prompt_index(params_key, embedding, generated_image_path)
+    logger.info("Generated image saved to: %s", generated_image_path)
+    return generated_image_path, image_bytes, None
+
+
 # https://docs.aws.amazon.com/bedrock/latest/userguide/model-parameters-titan-image.html#model-parameters-titan-image-api
-def prepare_request(
-    source_image_path,
+async def prepare_request(
+    source_image_bytes,
     mask_prompt,
     positive_prompt,
     negative_prompt,
     outpainting_mode,
     cfg_scale,
     seed,
+    latency_optimized=False,
+    similarity_threshold=1.0,
+    candidates=1,
     # image_width,
     # image_height
 ):
     """
     Prepare the request for outpainting with mask prompt.
+    Candidates are generated concurrently, each with the next seed.
     Args:
-        source_image_path (str): The path to the source image.
+        source_image_bytes (bytes): The source image.
         mask_prompt (str): The mask prompt to use.
         positive_prompt (str): The positive prompt to use.
         negative_prompt (str): The negative prompt to use.
         outpainting_mode (str): The outpainting mode to use.
         cfg_scale (float): The CFG scale to use.
-        seed (int): The seed to use.
+        seed (int): The seed to use for the first candidate.
+        latency_optimized (bool): Whether to use latency-optimized inference.
+        similarity_threshold (float): The minimum cosine similarity for reusing an image
+            generated from a similar positive prompt. 1.0 disables approximate matching.
+        candidates (int): The number of candidate images to generate.
         image_width (int): The width of the source image.
         image_height (int): The height of the source image.
     Returns:
-        generated_image_path (str): The path to the generated image.
+        generated_images (list): The path, bytes and reused-prompt similarity of each image.
+        failed_candidates (list): The seed and error of each candidate that failed.
     """
 
     try:
-        # Read image from file and encode as base64 strings.
-        with open(source_image_path, "rb") as image_file:
-            input_image = base64.b64encode(image_file.read()).decode("utf8")
-
         if not negative_prompt:
-            negative_prompt = "worst quality, low quality, low res, bad photo, bad photography, bad art, blur, blurry, grainy, ugly, asymmetrical, poorly lit, bad shadow, draft, cropped, out of frame, cut off, censored, jpeg artifacts, out of focus, glitch"
-        
-        body = json.dumps(
-            {
-                "taskType": "OUTPAINTING",
-                "outPaintingParams": {
-                    "text": positive_prompt,
-                    "negativeText": negative_prompt,
-                    "image": input_image,
-                    "maskPrompt": mask_prompt,
-                    "outPaintingMode": outpainting_mode,
-                },
-                "imageGenerationConfig": {
-                    "numberOfImages": 1,
-                    # "height": image_height,
-                    # "width": image_height,
-                    "cfgScale": cfg_scale,
-                    "seed": seed,
-                },
-            }
+            negative_prompt = FALLBACK_NEGATIVE_PROMPT
+
+        # Hash and encode image as base64 once, shared by every candidate.
+        input_image_hash = hashlib.sha256(source_image_bytes).hexdigest()
+        input_image = pybase64.b64encode(source_image_bytes)
+
+        seeds = [(seed + i) % (MAX_SEED + 1) for i in range(candidates)]
+        cache_keys = [
+            get_cache_key(
+                input_image_hash,
+                mask_prompt,
+                positive_prompt,
+                negative_prompt,
+                outpainting_mode,
+                cfg_scale,
+                candidate_seed,
+            )
+            for candidate_seed in seeds
+        ]
+
+        # Only embed the prompt, once for all candidates, if any candidate misses the cache.
+        embedding = None
+        if similarity_threshold < 1.0 and not all(
+            find_cached_image(cache_key, similarity_threshold)[0]
+            for cache_key in cache_keys
+        ):
+            embedding = await try_embed_prompt(positive_prompt)
+
+        # Return exceptions, so one failed candidate does not discard the others.
+        results = await asyncio.gather(
+            *(
+                generate_candidate(
+                    input_image,
+                    input_image_hash,
+                    cache_key,
+                    mask_prompt,
+                    positive_prompt,
+                    negative_prompt,
+                    outpainting_mode,
+                    cfg_scale,
+                    candidate_seed,
+                    latency_optimized,
+                    similarity_threshold,
+                    embedding,
+                )
+                for candidate_seed, cache_key in zip(seeds, cache_keys)
+            ),
+            return_exceptions=True,
         )
 
-        image_bytes = generate_image(body=body)
-        image = Image.open(io.BytesIO(image_bytes))
-        epoch_time = int(time.time())
-        generated_image_path = f"output/outpainting_{seed}_{epoch_time}.jpg"
-        image.save(generated_image_path)
-        logger.info("Generated image saved to: %s", generated_image_path)
-        return generated_image_path
+        generated_images = []
+        failed_candidates = []
+        for candidate_seed, result in zip(seeds, results):
+            if isinstance(result, (ClientError, ImageError, ThrottlingError)):
+                logger.error(f"Candidate with seed {candidate_seed} failed: {result}")
+                failed_candidates.append((candidate_seed, result))
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                generated_images.append(result)
+        return generated_images, failed_candidates
     except ClientError as err:
         message = err.response["Error"]["Message"]
         logger.error(f"A client error occurred: {message}")
     except ImageError as err:
         logger.error(f"A image error occurred: {err}")
+    return [], []
 
 
-def display_response(source_image_path, generated_image_path, analysis_time):
+def display_response(source_image_bytes, generated_images, analysis_time):
     """Display the response from the model.
     Args:
-        source_image_path (str): The path to the source image.
-        generated_image_path (str): The path to the generated image.
+        source_image_bytes (bytes): The source image.
+        generated_images (list): The path, bytes and reused-prompt similarity of each image.
         analysis_time (float): The time taken to analyze the image.
     Returns:
         None
     """
-    st.image(source_image_path, caption="Source Image", use_column_width=True)
-    st.image(generated_image_path, caption="Generated Image", use_column_width=True)
+    st.image(source_image_bytes, caption="Source Image", use_container_width=True)
+
+    if any(similarity is not None for _, _, similarity in generated_images):
+        st.info(
+            "Some images were reused from a similar prompt instead of being generated from this prompt. Set the Prompt Similarity Threshold to 1.0 to always generate new images."
+        )
 
-    generated_image = f"Generated image: {generated_image_path}"
+    columns = st.columns(len(generated_images))
+    for column, (_, generated_image_bytes, similarity) in zip(
+        columns, generated_images
+    ):
+        if similarity is None:
+            caption = "Generated Image"
+        else:
+            caption = f"Reused Image (prompt similarity {similarity:.2f})"
+        with column:
+            st.image(generated_image_bytes, caption=caption, use_container_width=True)
+
+    generated_image = "\n".join(
+        f"Generated image: {generated_image_path}"
+        if similarity is None
+        else f"Reused image: {generated_image_path}"
+        for generated_image_path, _, similarity in generated_images
+    )
     analysis_time_str = f"Response time: {analysis_time:.2f} seconds"
     st.text(f"{analysis_time_str}\n{generated_image}")
 
@@ -160,35 +866,41 @@ def main():
 
     st.markdown(hide_decoration_bar_style, unsafe_allow_html=True)
 
+    # Create the shared client on first render, which also warms up its connection.
+    get_bedrock_runtime()
+
     st.markdown("### Image Background Replacement on Amazon Bedrock")
     st.markdown(
         "Example of using outpainting with the Amazon Titan Image Generator v2 model on Amazon Bedrock to replace the background of an image. Uses 'promptable visual segmentation' as opposed to a separate image mask or alpha channel."
     )
 
-    image_width = 0
-    image_height = 0
-
     with st.form("my_form"):
         st.markdown("##### Inference Parameters")
 
         uploaded_image = st.file_uploader(label="Upload Source Image", type=["jpg", "jpeg", "png"])
 
         if uploaded_image is not None:
-            pil_image = Image.open(uploaded_image)
-            image_width = pil_image.width
-            image_height = pil_image.height
+            image_bytes = uploaded_image.getvalue()
+            image_info = read_image_info(image_bytes)
+            if image_info is None:
+                st.error("Unable to read the image. Please upload a valid JPEG or PNG file.")
+                uploaded_image = None
+            elif max(image_info["width"], image_info["height"]) > MAX_IMAGE_SIZE:
+                image_bytes = downscale_image(image_bytes)
+                downscaled_image_info = read_image_info(image_bytes)
+                st.info(
+                    f"Image downscaled from {image_info['width']}x{image_info['height']} to {downscaled_image_info['width']}x{downscaled_image_info['height']} pixels."
+                )
+                image_info = downscaled_image_info
 
+        if uploaded_image is not None:
             col1, col2 = st.columns(2)
             with col1:
-                st.image(uploaded_image, caption="Source Image", use_column_width=True)
+                st.image(image_bytes, caption="Source Image", use_container_width=True)
             with col2:
                 st.text(
-                    f"Type: {uploaded_image.type}\nFormat: {pil_image.format_description}\nMode: {pil_image.mode}\nSize (KB): {round(uploaded_image.size/1024, 2)}\nWidth: {pil_image.width}\nHeight: {pil_image.height}\nResolution (pixels/inch): {pil_image.info.get('dpi')}"
+                    f"Type: {uploaded_image.type}\nFormat: {image_info['format_description']}\nMode: {image_info['mode']}\nSize (KB): {round(len(image_bytes)/1024, 2)}\nWidth: {image_info['width']}\nHeight: {image_info['height']}"
                 )
-            image_bytes = uploaded_image.getvalue()
-            source_image_path = f"./tmp/{uploaded_image.name}"
-            with open(source_image_path, "wb") as f:
-                f.write(image_bytes)
 
         mask_prompt = st.text_input(
             label="Mask Prompt",
@@ -198,13 +910,13 @@ def main():
         positive_prompt = st.text_area(
             height=150,
             label="Positive Prompt",
-            value="Picturesque picnic scene in a sunlit park. Close-up view of a vibrant red and white checkered blanket spread out on lush, verdant grass. A single white plate sits at the center of the blanket. Towering, leafy trees frame the background, casting dappled shadows. Patches of azure sky peek through the canopy. Warm, cheerful atmosphere with soft lighting. Photorealistic style, high detail, 4K resolution.",
+            value=DEFAULT_POSITIVE_PROMPT,
         )
 
         negative_prompt = st.text_area(
             height=150,
             label="Negative Prompt (Optional)",
-            value="people, humans, animals, worst quality, low quality, low res, oversaturated, undersaturated, overexposed, underexposed, grayscale, b&w, bad photo, bad photography, bad art, watermark, signature, blur, blurry, grainy, ugly, asymmetrical, poorly lit, bad shadow, draft, cropped, out of frame, cut off, censored, jpeg artifacts, out of focus, glitch, duplicate, airbrushed, cartoon, anime, semi-realistic, cgi, render, blender, digital art, manga, amateur, 3D",
+            value=DEFAULT_NEGATIVE_PROMPT,
         )
 
         col1, col2 = st.columns(2)
@@ -216,7 +928,7 @@ def main():
             seed = st.slider(
                 "Seed",
                 min_value=0,
-                max_value=2147483647,
+                max_value=MAX_SEED,
                 value=1807028922,
                 step=1,
             )
@@ -228,48 +940,79 @@ def main():
             horizontal=True,
         )
 
+        candidates = st.slider(
+            "Candidates", min_value=1, max_value=4, value=1, step=1
+        )
+
+        similarity_threshold = st.slider(
+            "Prompt Similarity Threshold (1.0 disables reuse of similar prompts)",
+            min_value=0.80,
+            max_value=1.0,
+            value=0.95,
+            step=0.01,
+        )
+
+        latency_optimized = st.checkbox(
+            label="Latency-optimized inference",
+            value=False,
+        )
+        st.caption(
+            "Latency-optimized inference is only offered for select models and Regions, and may be rejected for Amazon Titan Image Generator."
+        )
+
         st.divider()
 
         submitted = st.form_submit_button("Submit")
 
-        if (
-            submitted
-            and uploaded_image is not None
-            and image_height <= 1408
-            and image_width <= 1408
-        ):
+        if submitted and uploaded_image is not None:
             with st.spinner():
                 start_time = datetime.datetime.now()
-                generated_image_path = prepare_request(
-                    source_image_path,
-                    mask_prompt,
-                    positive_prompt,
-                    negative_prompt,
-                    outpainting_mode,
-                    cfg_scale,
-                    seed,
-                    # source_image_width,
-                    # source_image_height
+                generated_images, failed_candidates = asyncio.run(
+                    prepare_request(
+                        image_bytes,
+                        mask_prompt,
+                        positive_prompt,
+                        negative_prompt,
+                        outpainting_mode,
+                        cfg_scale,
+                        seed,
+                        latency_optimized,
+                        similarity_threshold,
+                        candidates,
+                        # source_image_width,
+                        # source_image_height
+                    )
                 )
                 end_time = datetime.datetime.now()
                 analysis_time = (end_time - start_time).total_seconds()
-                if generated_image_path:
+                for failed_seed, err in failed_candidates:
+                    if isinstance(err, ThrottlingError):
+                        st.warning(
+                            f"Candidate with seed {failed_seed} was throttled by Amazon Bedrock. Please wait a moment and try again, or generate fewer candidates."
+                        )
+                    elif isinstance(err, ClientError):
+                        st.warning(
+                            f"Candidate with seed {failed_seed} failed: {err.response['Error']['Message']}"
+                        )
+                    else:
+                        st.warning(f"Candidate with seed {failed_seed} failed: {err}")
+                if generated_images:
                     display_response(
-                        source_image_path, generated_image_path, analysis_time
+                        image_bytes, generated_images, analysis_time
                     )
-                else:
+                elif not failed_candidates:
                     logger.error("Failed to get a valid response from the model.")
-        if (
-            submitted
-            and uploaded_image is not None
-            and (image_height > 1408 or image_width > 1408)
-        ):
-            st.error(
-                "Please upload an image with height and width less than or equal to 1408 pixels."
-            )
+                    st.error("Failed to get a valid response from the model.")
         if submitted and uploaded_image is None:
             st.error("Please upload an image file.")
 
+    # Source images are only written to disk on request; generated images are already cached.
+    if uploaded_image is not None and st.button("Save Session"):
+        source_image_path = f"./tmp/{uploaded_image.name}"
+        with open(source_image_path, "wb") as f:
+            f.write(uploaded_image.getvalue())
+        st.success(f"Source image saved to: {source_image_path}")
+
 
 if __name__ == "__main__":
     main()